@@ -2,17 +2,22 @@ import pygame
 import random
 import time
 import csv
+import functools
+import queue
+import threading
 import pandas as pd
-import ast
+import numpy as np
+import json
 import matplotlib.pyplot as plt
 import sys
 import serial
-from statistics import mean
+from statistics import mean, geometric_mean
 import os
 
 # ========== CONFIGURATION ==========
 SCREEN_WIDTH, SCREEN_HEIGHT = 800, 600
 TILE_SIZE = 50
+GRID_MARGIN = 100
 FPS = 60
 BLOCK_SIZE = 24
 TRIALS_PATH = "contextual_trials_chun1998_black_FULL.csv"
@@ -22,13 +27,19 @@ VIBRESP_PATH_TEMPLATE = "vibration_responses_{subject}.csv"
 STAIRCASE_TRIALS = 15
 PORT = "COM4"
 BAUDRATE = 115200
+SERIAL_WRITE_TIMEOUT = 0.05  # seconds; a stalled write is dropped rather than delaying later ones
+SERIAL_BUFFER_SIZE = 4096  # OS-level rx/tx buffer (only settable on Windows)
 DEFAULT_ESTIMATED_RT = 0.7
-STEP_SIZE = 1
+STEP_SIZES = [2, 1]  # staircase step shrinks after every 2 reversals; device levels are integers
+PRELIMINARY_REVERSALS = 2  # reversals at the coarse step, excluded from the threshold
+EXPERIMENTAL_REVERSALS = 8  # threshold = geometric mean of (up to) this many later reversals
 MAX_INTENSITY = 10
 MIN_INTENSITY = 2
 VIBRATION_PROPORTION = 0.75
+CSV_FLUSH_EVERY = 32  # buffered log rows written to disk in chunks of this size
 
 BACKGROUND_COLOR = (255, 255, 255)
+LINE_THICKNESS = 5
 COLOR_BLACK = (0, 0, 0)  # kept for text; shapes use palette below
 
 # --- Distractor/target colors (non-diagnostic), inspired by Chun & Jiang fig. ---
@@ -38,21 +49,64 @@ COLOR_PALETTE = [
     (126, 196, 125),  # green
     (120, 190, 220)   # blue
 ]
+L_ORIENTS = ['ul', 'ur', 'dl', 'dr']
+
+# Serial payloads pre-encoded for every valid intensity
+VIBRATION_PAYLOADS = {i: f"{i}".encode() for i in range(MIN_INTENSITY, MAX_INTENSITY + 1)}
 
 # ========== INIT ==========
-pygame.init()
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+# Only display + font are initialised: the task plays no sound, and the mixer's audio thread can preempt the main loop
+pygame.display.init()
+pygame.font.init()
+# No SCALED: the window must stay 1:1 so stimulus geometry is identical on every lab monitor
+screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.DOUBLEBUF)
 pygame.display.set_caption("Contextual Cueing with Vibration")
+# Drop mouse motion and other unused events at the SDL layer so the queue never backs up
+pygame.event.set_blocked(None)
+pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN])
 clock = pygame.time.Clock()
+# RTs are timed with perf_counter; add this offset to a perf_counter value to get epoch seconds
+PERF_COUNTER_EPOCH_OFFSET = time.time() - time.perf_counter()
 font = pygame.font.SysFont(None, 36)
 
 try:
-    arduino = serial.Serial(PORT, BAUDRATE, timeout=1)
-    time.sleep(2)
+    # DTR/RTS held low so opening the port does not auto-reset the Arduino (no 2 s boot wait)
+    arduino = serial.Serial()
+    arduino.port = PORT
+    arduino.baudrate = BAUDRATE
+    arduino.timeout = 1
+    arduino.write_timeout = SERIAL_WRITE_TIMEOUT
+    arduino.dtr = False
+    arduino.rts = False
+    arduino.open()
 except Exception:
     arduino = None
     print(f"WARNING: Could not open serial port {PORT}. Vibration disabled.")
 
+# Buffer sizing is an optional tweak; a failure here must not disable vibration
+if arduino and hasattr(arduino, "set_buffer_size"):
+    try:
+        arduino.set_buffer_size(rx_size=SERIAL_BUFFER_SIZE, tx_size=SERIAL_BUFFER_SIZE)
+    except Exception as e:
+        print(f"WARNING: Could not set serial buffer size: {e}")
+
+# Serial writes happen on a background thread so USB I/O never blocks the pygame loop
+vib_queue = queue.Queue()
+RESET_OUTPUT = b""  # queued between trials to discard stale, still-unsent bytes
+
+def vibration_writer():
+    for payload in iter(vib_queue.get, None):
+        try:
+            if payload == RESET_OUTPUT:
+                arduino.reset_output_buffer()
+            else:
+                arduino.write(payload)
+        except serial.SerialException as e:
+            print(f"WARNING: Vibration write failed: {e}")
+
+if arduino:
+    threading.Thread(target=vibration_writer, daemon=True).start()
+
 # ========== UTILITIES ==========
 def text_input(prompt):
     import tkinter as tk
@@ -61,128 +115,203 @@ def text_input(prompt):
     root.withdraw()
     return simpledialog.askstring("Input", prompt)
 
+@functools.lru_cache(maxsize=256)
+def render_text(message):
+    """Rasterize message once; repeated prompts reuse the cached surface."""
+    return font.render(message, True, COLOR_BLACK)
+
 def display_text(surface, message, x, y):
-    text = font.render(message, True, COLOR_BLACK)
-    surface.blit(text, (x, y))
+    surface.blit(render_text(message), (x, y))
 
 def send_vibration_intensity(intensity):
     if arduino:
-        arduino.write(f"{intensity}".encode())
+        payload = VIBRATION_PAYLOADS.get(intensity) or f"{intensity}".encode()
+        vib_queue.put_nowait(payload)
 
-def log_response(response, intensity, phase, writer):
-    writer.writerow({"response": response, "intensity": intensity, "phase": phase, "timestamp": time.time()})
+def log_response(response, intensity, phase, rows):
+    rows.append((response, intensity, phase, time.time()))
+
+def flush_rows(writer, rows):
+    """Write buffered log rows in one call and empty the buffer."""
+    if rows:
+        writer.writerows(rows)
+        rows.clear()
 
 # ========== STAIRCASE ==========
-def run_staircase_procedure(csv_writer):
+def run_staircase_procedure(staircase_rows):
     trial_count = 0
     intensity = 5
     reversals = []
     previous_direction = None
-    last_trial_time = time.time()
+    last_trial_time = time.perf_counter()
     random_interval = random.randint(1, 3)
 
-    while trial_count < STAIRCASE_TRIALS:
+    while trial_count < STAIRCASE_TRIALS and len(reversals) < PRELIMINARY_REVERSALS + EXPERIMENTAL_REVERSALS:
         screen.fill(BACKGROUND_COLOR)
         display_text(screen, f"Staircase Trial {trial_count+1}/{STAIRCASE_TRIALS}", 100, 100)
         display_text(screen, "Press UP if you feel vibration", 100, 200)
         display_text(screen, "Don't press if not", 100, 240)
         pygame.display.flip()
 
-        if time.time() - last_trial_time >= random_interval:
+        # sleep until the next vibration is due instead of redrawing the prompt every iteration.
+        # time.wait leaves the event queue untouched, so UP presses made before the vibration
+        # are still read (and scored) in the response window, as before.
+        remaining_ms = int((last_trial_time + random_interval - time.perf_counter()) * 1000)
+        if remaining_ms > 0:
+            pygame.time.wait(remaining_ms)
+
+        if time.perf_counter() - last_trial_time >= random_interval:
             send_vibration_intensity(intensity)
-            last_trial_time = time.time()
+            last_trial_time = time.perf_counter()
             random_interval = random.randint(1, 3)
             trial_count += 1
             response = 0
-            timeout = time.time() + 5
-
-            while time.time() < timeout:
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN and event.key == pygame.K_UP:
-                        response = 1
-                        break
-                if response:
+            timeout = time.perf_counter() + 5
+
+            # block until a key arrives or the window closes instead of polling each frame
+            remaining_ms = int((timeout - time.perf_counter()) * 1000)
+            while remaining_ms > 0:
+                event = pygame.event.wait(remaining_ms)
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_UP:
+                    response = 1
                     break
-                clock.tick(FPS)
+                remaining_ms = int((timeout - time.perf_counter()) * 1000)
 
-            log_response(response, intensity, "staircase", csv_writer)
+            log_response(response, intensity, "staircase", staircase_rows)
 
             direction = "down" if response else "up"
-            new_intensity = max(MIN_INTENSITY, intensity - STEP_SIZE) if response else min(MAX_INTENSITY, intensity + STEP_SIZE)
             if previous_direction and previous_direction != direction:
                 reversals.append(intensity)
             previous_direction = direction
-            intensity = new_intensity
+            step = STEP_SIZES[min(len(reversals) // 2, len(STEP_SIZES) - 1)]
+            intensity = max(MIN_INTENSITY, intensity - step) if response else min(MAX_INTENSITY, intensity + step)
 
-    threshold = sum(reversals[-6:]) / len(reversals[-6:]) if reversals else intensity
+    experimental = reversals[PRELIMINARY_REVERSALS:][:EXPERIMENTAL_REVERSALS] or reversals
+    threshold = geometric_mean(experimental) if experimental else intensity
 
     screen.fill(BACKGROUND_COLOR)
     display_text(screen, f"Staircase Done. Threshold: {threshold:.2f}", 100, 250)
     display_text(screen, "Press any key to start the main task.", 100, 300)
     pygame.display.flip()
-    while True:
-        if any(event.type == pygame.KEYDOWN for event in pygame.event.get()):
-            break
-        clock.tick(FPS)
+    while pygame.event.wait().type != pygame.KEYDOWN:
+        pass
 
     return round(threshold + 0.5)
 
 # ========== DRAWING ==========
+SHAPE_CACHE = {}
+SHAPE_SURFACE_HALF = TILE_SIZE + LINE_THICKNESS  # L arms reach a full tile from center
+
+# Line segments per shape as (dx1, dy1, dx2, dy2) offsets from the shape center
+_HALF = TILE_SIZE // 2
+SHAPE_OFFSETS = {
+    'T_left':  [(0, -_HALF, 0, _HALF), (-_HALF, 0, 0, 0)],      # stem, bar left
+    'T_right': [(0, -_HALF, 0, _HALF), (0, 0, _HALF, 0)],       # stem, bar right
+    'L_ul':    [(0, 0, 0, -TILE_SIZE), (0, 0, -_HALF, 0)],      # up + left
+    'L_ur':    [(0, 0, 0, -TILE_SIZE), (0, 0, _HALF, 0)],       # up + right
+    'L_dl':    [(0, 0, 0, TILE_SIZE), (0, 0, -_HALF, 0)],       # down + left
+    'L_dr':    [(0, 0, 0, TILE_SIZE), (0, 0, _HALF, 0)],        # down + right
+}
+
 def draw_shape(surface, shape, x, y, color):
     """Draw rotated T or L centered at (x, y)."""
-    thickness = 5
-    half = TILE_SIZE // 2
-
-    if shape == 'T_left':
-        pygame.draw.line(surface, color, (x, y - half), (x, y + half), thickness)  # stem
-        pygame.draw.line(surface, color, (x - half, y), (x, y), thickness)         # bar left
-
-    elif shape == 'T_right':
-        pygame.draw.line(surface, color, (x, y - half), (x, y + half), thickness)  # stem
-        pygame.draw.line(surface, color, (x, y), (x + half, y), thickness)         # bar right
-
-    elif shape.startswith('L_'):
-        tag = shape.split('_', 1)[1]  # 'ul','ur','dl','dr'
-        if tag == 'ul':  # up + left
-            pygame.draw.line(surface, color, (x, y), (x, y - TILE_SIZE), thickness)
-            pygame.draw.line(surface, color, (x, y), (x - half, y), thickness)
-        elif tag == 'ur':  # up + right
-            pygame.draw.line(surface, color, (x, y), (x, y - TILE_SIZE), thickness)
-            pygame.draw.line(surface, color, (x, y), (x + half, y), thickness)
-        elif tag == 'dl':  # down + left
-            pygame.draw.line(surface, color, (x, y), (x, y + TILE_SIZE), thickness)
-            pygame.draw.line(surface, color, (x, y), (x - half, y), thickness)
-        elif tag == 'dr':  # down + right
-            pygame.draw.line(surface, color, (x, y), (x, y + TILE_SIZE), thickness)
-            pygame.draw.line(surface, color, (x, y), (x + half, y), thickness)
+    for dx1, dy1, dx2, dy2 in SHAPE_OFFSETS.get(shape, ()):
+        pygame.draw.line(surface, color, (x + dx1, y + dy1), (x + dx2, y + dy2), LINE_THICKNESS)
+
+def get_shape_surface(shape, color):
+    """Return a transparent pre-rendered surface of shape/color, drawn once and cached."""
+    key = (shape, color)
+    surf = SHAPE_CACHE.get(key)
+    if surf is None:
+        size = 2 * SHAPE_SURFACE_HALF
+        surf = pygame.Surface((size, size), pygame.SRCALPHA).convert_alpha()
+        surf.fill((0, 0, 0, 0))
+        draw_shape(surf, shape, SHAPE_SURFACE_HALF, SHAPE_SURFACE_HALF, color)
+        SHAPE_CACHE[key] = surf
+    return surf
+
+def blit_shape(surface, shape, x, y, color):
+    """Blit the cached rendering of shape centered at (x, y)."""
+    surface.blit(get_shape_surface(shape, color), (x - SHAPE_SURFACE_HALF, y - SHAPE_SURFACE_HALF))
 
 # ========== CONTEXTUAL TASK ==========
-def run_trial(trial, trial_num, rt_history, vibration_intensity, vibrate_this_trial, vibresp_writer):
-    target_pos = ast.literal_eval(trial['target_pos'])
-    distractors = ast.literal_eval(trial['distractors'])
-    target_shape = trial['target_shape']
-    is_old = trial['is_old']
+# Layout cells are Python tuple literals; this maps them onto equivalent JSON arrays/strings
+LITERAL_TO_JSON = str.maketrans("()'", '[]"')
+
+def precompute_trials(trials_df):
+    """Parse all trial layouts once into pixel-coordinate arrays (one row per trial)."""
+    n = len(trials_df)
+    target_positions = [json.loads(p.translate(LITERAL_TO_JSON)) for p in trials_df['target_pos']]
+    distractor_lists = [json.loads(d.translate(LITERAL_TO_JSON)) for d in trials_df['distractors']]
+    max_d = max((len(d) for d in distractor_lists), default=0)
+
+    layout = {
+        'target_px': np.zeros(n, dtype=np.int32),
+        'target_py': np.zeros(n, dtype=np.int32),
+        'distractor_px': np.zeros((n, max_d), dtype=np.int32),
+        'distractor_py': np.zeros((n, max_d), dtype=np.int32),
+        'n_distractors': np.zeros(n, dtype=np.int32),
+        'target_shape': trials_df['target_shape'].to_numpy(dtype=object),
+        'is_old': trials_df['is_old'].to_numpy(dtype=bool),
+        'context_id': trials_df['context_id'].to_numpy(dtype=object),
+        'scene_rect': np.zeros((n, 4), dtype=np.int32),  # x, y, w, h covering every shape of the trial
+    }
+    for i, ((tx, ty), distractors) in enumerate(zip(target_positions, distractor_lists)):
+        layout['target_px'][i] = tx * TILE_SIZE + GRID_MARGIN
+        layout['target_py'][i] = ty * TILE_SIZE + GRID_MARGIN
+        layout['n_distractors'][i] = len(distractors)
+        for j, ((dx, dy), _) in enumerate(distractors):  # stored orient ignored; reassigned every trial
+            layout['distractor_px'][i, j] = dx * TILE_SIZE + GRID_MARGIN
+            layout['distractor_py'][i, j] = dy * TILE_SIZE + GRID_MARGIN
+
+        xs = [tx] + [dx for (dx, _), _ in distractors]
+        ys = [ty] + [dy for (_, dy), _ in distractors]
+        layout['scene_rect'][i] = (min(xs) * TILE_SIZE + GRID_MARGIN - SHAPE_SURFACE_HALF,
+                                   min(ys) * TILE_SIZE + GRID_MARGIN - SHAPE_SURFACE_HALF,
+                                   (max(xs) - min(xs)) * TILE_SIZE + 2 * SHAPE_SURFACE_HALF,
+                                   (max(ys) - min(ys)) * TILE_SIZE + 2 * SHAPE_SURFACE_HALF)
+    return layout
+
+def run_trial(trial_num, layout, rt_stats, vibration_intensity, vibrate_this_trial, vibresp_rows, full_redraw=True):
+    target_shape = layout['target_shape'][trial_num]
+    is_old = bool(layout['is_old'][trial_num])
     context_key = 'old' if is_old else 'new'
 
-    tx, ty = target_pos
-    x_target = tx * TILE_SIZE + 100
-    y_target = ty * TILE_SIZE + 100
+    x_target = int(layout['target_px'][trial_num])
+    y_target = int(layout['target_py'][trial_num])
+    n_distractors = int(layout['n_distractors'][trial_num])
+    distractor_px = layout['distractor_px'][trial_num, :n_distractors].tolist()
+    distractor_py = layout['distractor_py'][trial_num, :n_distractors].tolist()
 
     # estimated RT determines vibration offset
-    estimated_rt = mean(rt_history[context_key]) if rt_history[context_key] else DEFAULT_ESTIMATED_RT
+    rt_count, rt_sum = rt_stats[context_key]
+    estimated_rt = rt_sum / rt_count if rt_count else DEFAULT_ESTIMATED_RT
     vibration_offset = max(estimated_rt - 0.1, 0.1)
 
-    # --- Randomize L orientation & color every presentation ---
-    L_ORIENTS = ['ul', 'ur', 'dl', 'dr']
+    # --- Randomize L orientation & color every presentation (indices drawn up front in main) ---
+    ori_idx = layout['ori_idx'][trial_num].tolist()
+    col_idx = layout['col_idx'][trial_num].tolist()
     present_distractors = []
-    for item in distractors:
-        (dx, dy), _ = item  # ignore stored orient; reassign every trial
-        ori = random.choice(L_ORIENTS)
-        col = random.choice(COLOR_PALETTE)
-        present_distractors.append((dx, dy, ori, col))
-
-    # --- Target color from same palette (non-diagnostic) ---
-    target_color = random.choice(COLOR_PALETTE)
+    for j, (px, py) in enumerate(zip(distractor_px, distractor_py)):
+        ori = L_ORIENTS[ori_idx[j]]
+        col = COLOR_PALETTE[col_idx[j]]
+        present_distractors.append((px, py, ori, col))
+
+    # --- Target color from same palette (non-diagnostic); last color column ---
+    target_color = COLOR_PALETTE[col_idx[-1]]
+
+    # draw scene once (distractors first, then target); it stays static until the response.
+    # Straight after another trial only the region both scenes cover needs clearing.
+    if full_redraw or trial_num == 0:
+        dirty = screen.get_rect()
+    else:
+        dirty = pygame.Rect(layout['scene_rect'][trial_num].tolist())
+        dirty.union_ip(pygame.Rect(layout['scene_rect'][trial_num - 1].tolist()))
+    screen.fill(BACKGROUND_COLOR, dirty)
+    for (px, py, ori, col) in present_distractors:
+        blit_shape(screen, f'L_{ori}', px, py, col)
+    blit_shape(screen, target_shape, x_target, y_target, target_color)
+    pygame.display.update(dirty)
 
     running = True
     response = None
@@ -191,58 +320,55 @@ def run_trial(trial, trial_num, rt_history, vibration_intensity, vibrate_this_tr
     vibration_time = None
     vibration_response = False
     vibration_rt = None
-    trial_start = time.time()
     vibration_time_abs = None
     k_up_time_abs = None
 
+    # bind the globals/attributes used every frame to locals (LOAD_FAST instead of dict lookups)
+    perf = time.perf_counter
+    get_events = pygame.event.get
+    tick = clock.tick
+    fps = FPS
+    QUIT, KEYDOWN = pygame.QUIT, pygame.KEYDOWN
+    K_LEFT, K_RIGHT, K_UP = pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP
+
+    trial_start = perf()
     while running:
-        screen.fill(BACKGROUND_COLOR)
-        now = time.time()
+        now = perf()
 
         # send vibration just before estimated response
         if vibrate_this_trial and not vibration_sent and now - trial_start >= vibration_offset:
             send_vibration_intensity(int(vibration_intensity))
             vibration_sent = True
             vibration_time = now - trial_start
-            vibration_time_abs = time.time()
+            vibration_time_abs = perf()
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+        for event in get_events():
+            if event.type == QUIT:
                 return 'INTERRUPT'
-            elif event.type == pygame.KEYDOWN:
-                if not response and event.key in [pygame.K_LEFT, pygame.K_RIGHT]:
-                    response = 'T_right' if event.key == pygame.K_LEFT else 'T_left'
-                    rt = time.time() - trial_start
+            elif event.type == KEYDOWN:
+                if not response and (event.key == K_LEFT or event.key == K_RIGHT):
+                    response = 'T_right' if event.key == K_LEFT else 'T_left'
+                    rt = perf() - trial_start
                     running = False
-                elif vibration_sent and event.key == pygame.K_UP:
-                    k_up_time_abs = time.time()
+                elif vibration_sent and event.key == K_UP:
+                    k_up_time_abs = perf()
                     vibration_response = True
                     if vibration_time_abs:
                         vibration_rt = k_up_time_abs - vibration_time_abs
 
-        # draw scene (distractors first, then target)
-        for (dx, dy, ori, col) in present_distractors:
-            draw_shape(screen, f'L_{ori}', dx * TILE_SIZE + 100, dy * TILE_SIZE + 100, col)
-
-        draw_shape(screen, target_shape, x_target, y_target, target_color)
-
-        pygame.display.flip()
-        clock.tick(FPS)
+        tick(fps)
 
     if rt:
-        rt_history[context_key].append(rt)
+        rt_stats[context_key][0] += 1
+        rt_stats[context_key][1] += rt
 
-    if vibresp_writer:
-        vibresp_writer.writerow({
-            'trial_num': trial_num,
-            'vibration_sent': vibrate_this_trial,
-            'vibration_time_abs': vibration_time_abs,
-            'k_up_time_abs': k_up_time_abs
-        })
+    if vibresp_rows is not None:
+        vibresp_rows.append((trial_num, vibrate_this_trial, vibration_time_abs, k_up_time_abs,
+                             PERF_COUNTER_EPOCH_OFFSET))
 
     return {
         'trial_num': trial_num,
-        'context_id': trial['context_id'],
+        'context_id': layout['context_id'][trial_num],
         'is_old': is_old,
         'target_shape': target_shape,
         'response': response,
@@ -255,13 +381,22 @@ def run_trial(trial, trial_num, rt_history, vibration_intensity, vibrate_this_tr
     }
 
 def generate_summary_plot(results, subject):
-    df = pd.DataFrame(results)
-    df['epoch'] = df['trial_num'] // BLOCK_SIZE
-    summary = df.groupby(['epoch', 'is_old'])['rt'].mean().reset_index()
-    summary['label'] = summary['is_old'].map({True: 'Old Context', False: 'New Context'})
+    valid = [r for r in results if r['rt'] is not None]
+    rt = np.array([r['rt'] for r in valid], dtype=float)
+    trial_num = np.array([r['trial_num'] for r in valid], dtype=np.int64)
+    is_old = np.array([bool(r['is_old']) for r in valid], dtype=np.int64)
+
+    # mean RT per (epoch, is_old) cell, keyed as epoch * 2 + is_old
+    key = (trial_num // BLOCK_SIZE) * 2 + is_old
+    sums = np.bincount(key, weights=rt)
+    counts = np.bincount(key)
+
     plt.figure(figsize=(10, 6))
-    for label, group in summary.groupby('label'):
-        plt.plot(group['epoch'], group['rt'] * 1000, marker='o', label=label)
+    for old, label in ((0, 'New Context'), (1, 'Old Context')):
+        cells = np.arange(old, len(counts), 2)
+        cells = cells[counts[cells] > 0]
+        if cells.size:
+            plt.plot(cells // 2, sums[cells] / counts[cells] * 1000, marker='o', label=label)
     plt.xlabel("Block")
     plt.ylabel("Search RT (ms)")
     plt.title(f"RT by Block - {subject}")
@@ -275,16 +410,13 @@ def show_message(message, wait_for_key=False):
     screen.fill(BACKGROUND_COLOR)
     lines = message.split("\n")
     for i, line in enumerate(lines):
-        text = font.render(line, True, COLOR_BLACK)
+        text = render_text(line)
         rect = text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + i * 40))
         screen.blit(text, rect)
     pygame.display.flip()
     if wait_for_key:
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN:
-                    return
-            clock.tick(FPS)
+        while pygame.event.wait().type != pygame.KEYDOWN:
+            pass
     else:
         time.sleep(2)
 
@@ -296,49 +428,67 @@ def main():
         return
 
     trials_df = pd.read_csv(TRIALS_PATH)
+    layout = precompute_trials(trials_df)
+    n_trials, max_d = layout['distractor_px'].shape
+    layout['ori_idx'] = np.random.randint(0, len(L_ORIENTS), size=(n_trials, max_d))
+    layout['col_idx'] = np.random.randint(0, len(COLOR_PALETTE), size=(n_trials, max_d + 1))
     results = []
-    rt_history = {'old': [], 'new': []}
+    rt_stats = {'old': [0, 0.0], 'new': [0, 0.0]}  # running [count, sum] of RTs per context
 
     # Run Staircase
     staircase_file = open(f"staircase_results_{subject}.csv", "w", newline='')
-    writer = csv.DictWriter(staircase_file, fieldnames=["response", "intensity", "phase", "timestamp"])
-    writer.writeheader()
-    threshold = run_staircase_procedure(writer)
-    staircase_file.close()
-
-    # Prepare vibration response logger
+    writer = csv.writer(staircase_file)
+    writer.writerow(["response", "intensity", "phase", "timestamp"])
+    staircase_rows = []
+    try:
+        threshold = run_staircase_procedure(staircase_rows)
+    finally:
+        flush_rows(writer, staircase_rows)
+        staircase_file.close()
+
+    # Prepare vibration response logger (rows are buffered and flushed in chunks)
     vibresp_file = open(VIBRESP_PATH_TEMPLATE.format(subject=subject), "w", newline='')
-    vibresp_writer = csv.DictWriter(vibresp_file, fieldnames=["trial_num", "vibration_sent", "vibration_time_abs", "k_up_time_abs"])
-    vibresp_writer.writeheader()
+    vibresp_writer = csv.writer(vibresp_file)
+    vibresp_writer.writerow(["trial_num", "vibration_sent", "vibration_time_abs", "k_up_time_abs",
+                             "perf_counter_epoch_offset"])
+    vibresp_rows = []
 
     show_message("Contextual Cueing Task Starting\nPress LEFT/RIGHT for T orientation\nPress UP if you feel vibration", wait_for_key=True)
 
     total_trials = len(trials_df)
-    vibration_trials = random.sample(range(total_trials), int(total_trials * VIBRATION_PROPORTION))
-
-    for i, row in trials_df.iterrows():
-        if i % BLOCK_SIZE == 0 and i > 0:
-            block_df = pd.DataFrame(results[-BLOCK_SIZE:])
-            avg_rt = block_df['rt'].mean()
-            acc = block_df['correct'].mean() * 100
-            show_message(f"Block {i // BLOCK_SIZE} complete\nAvg RT: {avg_rt:.2f}s, Accuracy: {acc:.1f}%", wait_for_key=True)
-
-        vibrate_now = i in vibration_trials
-        result = run_trial(row, i, rt_history, threshold, vibrate_now, vibresp_writer)
-        if result == 'INTERRUPT':
-            break
-        results.append(result)
-
-    vibresp_file.close()
+    vib_mask = np.zeros(total_trials, dtype=bool)
+    vib_mask[np.random.choice(total_trials, int(total_trials * VIBRATION_PROPORTION), replace=False)] = True
+
+    try:
+        for i in range(total_trials):
+            if i % BLOCK_SIZE == 0 and i > 0:
+                tail = results[-BLOCK_SIZE:]
+                block_rts = [r['rt'] for r in tail if r['rt'] is not None]
+                avg_rt = mean(block_rts) if block_rts else float('nan')
+                acc = 100.0 * sum(1 for r in tail if r['correct']) / len(tail)
+                show_message(f"Block {i // BLOCK_SIZE} complete\nAvg RT: {avg_rt:.2f}s, Accuracy: {acc:.1f}%", wait_for_key=True)
+
+            vibrate_now = bool(vib_mask[i])
+            if arduino:
+                vib_queue.put_nowait(RESET_OUTPUT)
+            # trials that follow a message screen must clear the whole display
+            result = run_trial(i, layout, rt_stats, threshold, vibrate_now, vibresp_rows,
+                               full_redraw=(i % BLOCK_SIZE == 0))
+            if result == 'INTERRUPT':
+                break
+            results.append(result)
+
+            if len(vibresp_rows) >= CSV_FLUSH_EVERY:
+                flush_rows(vibresp_writer, vibresp_rows)
+    finally:
+        flush_rows(vibresp_writer, vibresp_rows)
+        vibresp_file.close()
 
     if results:
         results_path = RESULTS_PATH_TEMPLATE.format(subject=subject)
-        with open(results_path, "w", newline='') as file:
-            fieldnames = ['trial_num', 'context_id', 'is_old', 'target_shape', 'response', 'correct',
-                          'rt', 'vibration_time', 'rt_minus_vibration', 'vibration_response', 'vibration_rt']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(results)
+        fieldnames = ['trial_num', 'context_id', 'is_old', 'target_shape', 'response', 'correct',
+                      'rt', 'vibration_time', 'rt_minus_vibration', 'vibration_response', 'vibration_rt']
+        pd.DataFrame(results, columns=fieldnames).to_csv(results_path, index=False)
         generate_summary_plot(results, subject)
 
     show_message("Experiment complete. Thank you!")